@@ -31,6 +31,99 @@ import freenect
 import numpy
 import scipy
 import scipy.ndimage
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+try:
+    import cc3d
+except ImportError:
+    cc3d = None
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# depth approximation from ROS, in mm, looked up for every possible uint16 depth
+DEPTH_TO_MM = (1000.0/(-0.00307 * numpy.arange(65536) + 3.33)).astype(numpy.float32)
+
+def fill_holes(mask):
+    """fills in any background not connected to the edge of a boolean mask"""
+    if cv2 is None:
+        if flood_background is not None:
+            return ~flood_background(mask)
+        return scipy.ndimage.morphology.binary_fill_holes(mask)
+    # pad so all of the outside background is connected, then flood it from a corner
+    background = numpy.pad(~mask, 1, 'constant', constant_values=True).view(numpy.uint8)
+    flood_mask = numpy.zeros((background.shape[0]+2, background.shape[1]+2), numpy.uint8)
+    cv2.floodFill(background, flood_mask, (0,0), 2)
+    return background[1:-1,1:-1] != 2
+
+def erode(mask):
+    """erodes a boolean mask by one pixel, treating everything past the edge as empty"""
+    if cv2 is None:
+        return scipy.ndimage.morphology.binary_erosion(mask)
+    # same cross shaped element and zero border as binary_erosion
+    kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3,3))
+    # bool and uint8 share a layout, so view rather than copy on the way in and out
+    eroded = cv2.erode(mask.view(numpy.uint8), kernel, borderType=cv2.BORDER_CONSTANT, borderValue=0)
+    return eroded.view(bool)
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def threshold_kernel(depth, face_depth, adjusted, threshold):
+        """the same as FaceCube.generate_threshold, but in one pass to find
+        the closest depth and one more to threshold, instead of four"""
+        closest = 65535
+        for i in prange(depth.shape[0]):
+            for j in range(depth.shape[1]):
+                d = depth[i,j]
+                # the image breaks down when you get too close, so cap it at around 50cm
+                if d <= 500:
+                    d += 2047
+                adjusted[i,j] = d
+                closest = min(closest, d)
+        closest_cm = 100.0/(-0.00307 * closest + 3.33)
+        farthest = (100/(closest_cm + face_depth) - 3.33)/-0.00307
+        for i in prange(depth.shape[0]):
+            for j in range(depth.shape[1]):
+                d = adjusted[i,j]
+                threshold[i,j] = d if d <= farthest else 0
+
+    @njit(cache=True)
+    def flood_background(mask):
+        """marks the background that is 4-connected to the edge of mask in a
+        single pass, rather than dilating until nothing changes"""
+        h, w = mask.shape
+        outside = numpy.zeros((h,w), numpy.bool_)
+        # every pixel is pushed at most once, since it is marked when pushed
+        stack = numpy.empty(h*w, numpy.int64)
+        top = 0
+        for i in range(h):
+            for j in range(w):
+                if (i == 0 or j == 0 or i == h-1 or j == w-1) and not mask[i,j]:
+                    outside[i,j] = True
+                    stack[top] = i*w + j
+                    top += 1
+        while top > 0:
+            top -= 1
+            i = stack[top] // w
+            j = stack[top] % w
+            for (ni, nj) in ((i-1,j), (i+1,j), (i,j-1), (i,j+1)):
+                if 0 <= ni < h and 0 <= nj < w and not mask[ni,nj] and not outside[ni,nj]:
+                    outside[ni,nj] = True
+                    stack[top] = ni*w + nj
+                    top += 1
+        return outside
+else:
+    threshold_kernel = None
+    flood_background = None
+
+def reuse_buffer(buffer, shape):
+    """returns buffer if it is already the right shape, otherwise a new uint16 array"""
+    if buffer is None or buffer.shape != shape:
+        return numpy.empty(shape, numpy.uint16)
+    return buffer
 
 class PlyWriter(object):
     """Writes out the point cloud in the PLY file format
@@ -41,34 +134,44 @@ class PlyWriter(object):
         # depth to calculate x and y from, to keep a uniform perspective
         self.z_p = 0
         
-    def to_world(self, point):
-        x_out = float(point[0] - self.dims[0] / 2) * self.scale
-        y_out = float(point[1] - self.dims[1] / 2) * self.scale
-        return (x_out, y_out)
+    def to_world(self, points):
+        """converts the pixel x and y in the first two columns of points to mm,
+        in place so float32 points stay float32"""
+        # from http://openkinect.org/wiki/Imaging_Information
+        points[:,:2] -= self.center
+        points[:,:2] *= self.scale
         
     def save(self,array,leave_holes):
-        points = []
-        
         farthest = numpy.amax(array)
-        farthest_mm = 1000.0/(-0.00307 * farthest + 3.33)
+        farthest_mm = DEPTH_TO_MM[farthest]
         self.z_p = farthest_mm
         self.dims = array.shape
         minDistance = -100
         scaleFactor = 0.0021
         self.scale = float(self.z_p + minDistance) * scaleFactor
+        self.center = (self.dims[0] / 2, self.dims[1] / 2)
         
         a = numpy.argwhere(array)
-        min_point, max_point = a.min(0), a.max(0) + 1
-        min_point = self.to_world(min_point)
-        max_point = self.to_world(max_point)
+        bounds = numpy.array([a.min(0), a.max(0) + 1], numpy.float64)
+        self.to_world(bounds)
+        min_point, max_point = bounds.tolist()
         center_mm = ((min_point[0]+max_point[0])/2.0,(min_point[1]+max_point[1])/2)
         size_mm = (max_point[0]-min_point[0],max_point[1]-min_point[1])
 
-        points.extend(self.outline_points(array,farthest,leave_holes))
-        points.extend(self.back_points(array,farthest,leave_holes))
-        points.extend(self.mesh_points(array))
+        mask = array != 0
+        if not leave_holes:
+            mask = fill_holes(mask)
+        outline = array * (mask & ~erode(mask))
+        
+        # all the points go into one array, each stage filling in its own rows
+        num_points = (self.column_lengths(outline[outline != 0],farthest).sum() +
+                      numpy.count_nonzero(mask) + numpy.count_nonzero(array))
+        points = numpy.empty((num_points,3), numpy.float32)
+        end = self.outline_points(outline,farthest,points,0)
+        end = self.back_points(mask,farthest,points,end)
+        end = self.mesh_points(array,points,end)
         
-        f = open(self.name,'w')
+        f = open(self.name,'wb')
         
         self.write_header(f,points)
         self.write_points(f,points,farthest_mm,center_mm)
@@ -78,97 +181,130 @@ class PlyWriter(object):
         return size_mm
         
     # inspired by, but not based on http://borglabs.com/blog/create-point-clouds-from-kinect
-    def mesh_points(self,array):
-        points = []
+    def mesh_points(self,array,points,start):
+        """writes the nonzero points of array in mm into points from start,
+        returning the index after the last one"""
+        ii, jj = numpy.nonzero(array)
+        end = start + len(ii)
         
-        # depth approximation from ROS, in mm
-        array = (array != 0) * 1000.0/(-0.00307 * array + 3.33)
+        points[start:end,2] = DEPTH_TO_MM[array[ii,jj]]
+        points[start:end,0] = ii
+        points[start:end,1] = jj
+        self.to_world(points[start:end])
         
-        for i in range(0,self.dims[0]):
-            for j in range(0,self.dims[1]):
-                z = array[i,j]
-                if z:
-                    # from http://openkinect.org/wiki/Imaging_Information
-                    (x, y) = self.to_world((i, j))
-                    points.append((x,y,z))
-                    
-        return points
+        return end
+        
+    def column_lengths(self,z0,depth):
+        """number of points in the column behind each outline depth"""
+        return numpy.clip(int(depth) - z0.astype(numpy.int64) - 1, 0, None)
         
-    def outline_points(self,array,depth,leave_holes):
+    def outline_points(self,outline,depth,points,start):
         """Adds an outline going back to the farthest depth to give MeshLab an
         easier point cloud to turn into a solid"""
-        points = []
+        ii, jj = numpy.nonzero(outline)
+        z0 = outline[ii,jj]
+        # every outline pixel gets a column of points from just behind it back to depth
+        counts = self.column_lengths(z0,depth)
+        end = start + counts.sum()
+        offsets = numpy.cumsum(counts) - counts
+        # int32 is plenty for these and halves the biggest temporaries
+        z = numpy.repeat((z0 + 1 - offsets).astype(numpy.int32), counts)
+        z += numpy.arange(end - start, dtype=numpy.int32)
         
-        mask = array != 0
-        if not leave_holes:
-            scipy.ndimage.morphology.binary_fill_holes(mask, output=mask)
-        outline = array * (mask - scipy.ndimage.morphology.binary_erosion(mask))
+        points[start:end,2] = DEPTH_TO_MM[z]
+        points[start:end,0] = numpy.repeat(ii.astype(numpy.int32), counts)
+        points[start:end,1] = numpy.repeat(jj.astype(numpy.int32), counts)
+        self.to_world(points[start:end])
         
-        for i in range(0,self.dims[0]):
-            for j in range(0,self.dims[1]):
-                z = outline[i,j]
-                if z:
-                    z += 1
-                    while z < depth:
-                        z_mm = 1000.0/(-0.00307 * z + 3.33)
-                        (x, y) = self.to_world((i, j))
-                        points.append((x,y,z_mm))
-                        z += 1
+        return end
         
-        return points
-        
-    def back_points(self,array,depth,leave_holes):
+    def back_points(self,mask,depth,points,start):
         """Adds a plane of points at the maximum depth to make it easier for MeshLab
         to mesh a solid"""
-        mask = array != 0
-        if not leave_holes:
-            scipy.ndimage.morphology.binary_fill_holes(mask, output=mask)
-        array = depth * mask
-        
-        return self.mesh_points(array)
+        return self.mesh_points(depth * mask,points,start)
         
     def write_header(self,f,points):
-        f.write('ply\n')
-        f.write('format ascii 1.0\n')
-        f.write('element vertex %d\n' % len(points))
-        f.write('property float x\n')
-        f.write('property float y\n')
-        f.write('property float z\n')
-        f.write('end_header\n')
+        f.write(b'ply\n')
+        f.write(b'format binary_little_endian 1.0\n')
+        f.write(b'element vertex %d\n' % len(points))
+        f.write(b'property float x\n')
+        f.write(b'property float y\n')
+        f.write(b'property float z\n')
+        f.write(b'end_header\n')
         
     def write_points(self,f,points,farthest,center):
         """writes out the points with z starting at 0"""
-        for point in points:
-            f.write('%f %f %f\n' % (point[0]-center[0],point[1]-center[1],farthest-point[2]))
+        points[:,0] -= center[0]
+        points[:,1] -= center[1]
+        points[:,2] = farthest - points[:,2]
+        f.write(points.astype('<f4', copy=False).tobytes())
         
 
 class FaceCube(object):
     def __init__(self):
-        self.depth, timestamp = freenect.sync_get_depth()
+        # 2 when working on a half resolution preview of the frame
+        self.step = 1
         self.threshold = None
+        # buffers that are written over every frame instead of reallocated
+        self.depth_buffer = None
+        self.threshold_buffer = None
+        self.segmented_buffer = None
+        # connected segments of the current threshold, labelled on demand
+        self.labels = None
         self.segmented = None
         self.selected_segment = None
-        pass
+        self.update()
     
     def update(self):
         """grabs a new frame from the Kinect"""
         depth_rotated, timestamp = freenect.sync_get_depth()
-        self.depth = depth_rotated.transpose()
+        # copied once so everything after works on unit stride rows
+        self.frame = numpy.ascontiguousarray(depth_rotated.transpose())
+        self.depth = numpy.ascontiguousarray(self.frame[::self.step,::self.step])
+        
+    def set_preview(self, preview):
+        """switches between working on the full frame and on a half resolution
+        preview of it that is much quicker to redo every frame"""
+        self.step = 2 if preview else 1
+        self.depth = numpy.ascontiguousarray(self.frame[::self.step,::self.step])
         
     def generate_threshold(self, face_depth):
         """thresholds out the closest face_depth cm of stuff"""
-        # the image breaks down when you get too close, so cap it at around 50cm
-        self.depth = self.depth + 2047 * (self.depth <= 500)
-        closest = numpy.amin(self.depth)
-        closest_cm = 100.0/(-0.00307 * closest + 3.33)
-        farthest = (100/(closest_cm + face_depth) - 3.33)/-0.00307
-        self.threshold = self.depth * (self.depth <= farthest)
+        self.depth_buffer = reuse_buffer(self.depth_buffer, self.depth.shape)
+        self.threshold_buffer = reuse_buffer(self.threshold_buffer, self.depth.shape)
+        if threshold_kernel is not None:
+            threshold_kernel(self.depth, face_depth, self.depth_buffer, self.threshold_buffer)
+        else:
+            # the image breaks down when you get too close, so cap it at around 50cm
+            numpy.add(self.depth, numpy.uint16(2047) * (self.depth <= 500), out=self.depth_buffer)
+            closest = numpy.amin(self.depth_buffer)
+            closest_cm = 100.0/(-0.00307 * closest + 3.33)
+            farthest = (100/(closest_cm + face_depth) - 3.33)/-0.00307
+            numpy.multiply(self.depth_buffer, self.depth_buffer <= farthest, out=self.threshold_buffer)
+        self.depth = self.depth_buffer
+        # while paused the same threshold comes out every frame, so keep its labels
+        if self.threshold is None or not numpy.array_equal(self.threshold_buffer, self.threshold):
+            # the old threshold's array gets written over next frame
+            self.threshold, self.threshold_buffer = self.threshold_buffer, self.threshold
+            self.labels = None
+    
+    def label_segments(self):
+        """labels the connected segments of the threshold, only relabelling
+        when the threshold has changed"""
+        if self.labels is None:
+            if cc3d is not None:
+                # 4-connected like scipy's default structure
+                self.labels = cc3d.connected_components(self.threshold != 0, connectivity=4, return_N=True)
+            else:
+                self.labels = scipy.ndimage.measurements.label(self.threshold)
+        return self.labels
     
     def select_segment(self,point):
         """picks a segment at a specific point.  if there is no segment there,
         it resets to just show everything within the thresholded image"""
-        segments, num_segments = scipy.ndimage.measurements.label(self.threshold)
-        selected = segments[point[0],point[1]]
+        segments, num_segments = self.label_segments()
+        # points are always in full resolution coordinates
+        selected = segments[point[0] // self.step,point[1] // self.step]
         
         if selected:
             self.selected_segment = (point[0],point[1])
@@ -179,10 +315,12 @@ class FaceCube(object):
     def segment(self):
         """does the actual segmenting"""
         if self.selected_segment != None:
-            segments, num_segments = scipy.ndimage.measurements.label(self.threshold)
-            selected = segments[self.selected_segment]
+            segments, num_segments = self.label_segments()
+            selected = segments[self.selected_segment[0] // self.step,self.selected_segment[1] // self.step]
             if selected:
-                self.segmented = self.threshold * (segments == selected)
+                self.segmented_buffer = reuse_buffer(self.segmented_buffer, self.threshold.shape)
+                numpy.multiply(self.threshold, segments == selected, out=self.segmented_buffer)
+                self.segmented = self.segmented_buffer
             else:
                 self.segmented = None
         
@@ -190,7 +328,16 @@ class FaceCube(object):
         """fills holes in the object with an adjustable window size
         bigger windows fill bigger holes, but will start to alias the object"""
         if self.segmented != None:
-            self.segmented = scipy.ndimage.morphology.grey_closing(self.segmented,size=(window,window))
+            # the window is in full resolution pixels, rounded up so every
+            # step still changes the preview
+            window = max(1, (window + self.step - 1) // self.step)
+            if cv2 is not None:
+                kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (window,window))
+                # anchored like grey_closing so even windows don't shift the object
+                dilated = cv2.dilate(self.segmented.astype(numpy.uint16, copy=False), kernel, anchor=((window-1)//2,(window-1)//2))
+                self.segmented = cv2.erode(dilated, kernel, anchor=(window//2,window//2))
+            else:
+                self.segmented = scipy.ndimage.morphology.grey_closing(self.segmented,size=(window,window))
             
     def get_array(self):
         if self.segmented != None:
@@ -215,6 +362,15 @@ def facecube_usage():
     print 'S            Saves the object as a point cloud, filename.ply'
     print 'O            Outputs the object as a solid, filename.stl'
     print 'P            Saves a screenshot as filename.png'
+    print 'L            Toggles a half resolution preview, which is faster to redo'
+    print '             every frame.  Saving always uses the full resolution.'
+        
+def process(facecube, face_depth, hole_filling):
+    """thresholds, segments and hole fills the current frame"""
+    facecube.generate_threshold(face_depth)
+    facecube.segment()
+    if hole_filling:
+        facecube.hole_fill(hole_filling)
         
 def save_ply(facecube, filename, donut):
     print "Saving array as %s.ply..." % filename
@@ -235,14 +391,19 @@ if __name__ == '__main__':
     from pygame.locals import *
 
     facecube_usage()
-    size = (640, 480)
+    display_size = (640, 480)
     pygame.init()
-    display = pygame.display.set_mode(size, 0)
+    display = pygame.display.set_mode(display_size, 0)
+    # reused while the array being shown stays the same size
+    surface = None
+    # the preview scaled up to the window, in the same format as surface
+    scaled = None
     face_depth = 10.0
     facecube = FaceCube()
     going = True
     capturing = True
     donut = False
+    preview = False
     hole_filling = 0
     changing_depth = 0.0
     filename = 'facecube_test'
@@ -256,6 +417,11 @@ if __name__ == '__main__':
                 going = False
                 
             elif e.type == KEYDOWN:
+                if preview and e.key in (K_s, K_o, K_p, K_1, K_2, K_3):
+                    # save and screenshot from the full resolution frame, not the preview
+                    facecube.set_preview(False)
+                    process(facecube, face_depth, hole_filling)
+                    
                 if e.key == K_UP:
                     changing_depth = 1.0
                 elif e.key == K_DOWN:
@@ -274,6 +440,12 @@ if __name__ == '__main__':
                     if donut:
                         donutstring = "on"
                     print "Turning donut mode %s" % (donutstring)
+                elif e.key == K_l:
+                    preview = not preview
+                    previewstring = "off"
+                    if preview:
+                        previewstring = "on"
+                    print "Turning preview mode %s" % (previewstring)
                 elif e.key == K_s:
                     save_ply(facecube, filename, donut)
                 elif e.key == K_o:
@@ -307,14 +479,24 @@ if __name__ == '__main__':
                 
         if capturing:
             facecube.update()
+        facecube.set_preview(preview)
         
         face_depth = min(max(0.0,face_depth + changing_depth),2047.0)
         
-        facecube.generate_threshold(face_depth)
-        facecube.segment()
-        if hole_filling:
-            facecube.hole_fill(hole_filling)
+        process(facecube, face_depth, hole_filling)
         
         # this is not actually correct, but it sure does look cool!
-        display.blit(pygame.surfarray.make_surface(facecube.get_array()),(0,0))
+        array = facecube.get_array()
+        if surface is None or surface.get_size() != array.shape:
+            surface = pygame.surfarray.make_surface(array)
+            scaled = None
+        else:
+            pygame.surfarray.blit_array(surface, array)
+        if preview:
+            if scaled is None:
+                scaled = pygame.Surface(display_size, 0, surface)
+            pygame.transform.scale(surface, display_size, scaled)
+            display.blit(scaled,(0,0))
+        else:
+            display.blit(surface,(0,0))
         pygame.display.flip()